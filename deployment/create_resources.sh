@@ -3,6 +3,7 @@ PROJECT_ID="data-analysis-webapp"
 BUCKET_NAME="data-analysis-upload-1000"
 BQ_DATASET="analysis_dataset"
 PUBSUB_TOPIC="sql-import-topic"
+RUNTIME_SA="github-developer@data-analysis-webapp.iam.gserviceaccount.com"
 
 gcloud config set project $PROJECT_ID
 
@@ -14,3 +15,10 @@ bq --location=US mk --dataset $PROJECT_ID:$BQ_DATASET
 
 echo "Creating Pub/Sub topic..."
 gcloud pubsub topics create $PUBSUB_TOPIC
+
+# The webapp signs download URLs through IAM signBlob with its own identity
+echo "Allowing the runtime service account to sign URLs..."
+gcloud services enable iamcredentials.googleapis.com
+gcloud iam service-accounts add-iam-policy-binding $RUNTIME_SA \
+  --member="serviceAccount:$RUNTIME_SA" \
+  --role="roles/iam.serviceAccountTokenCreator"
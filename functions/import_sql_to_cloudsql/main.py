@@ -1,5 +1,5 @@
 import os
-import json
+import orjson
 import base64
 import subprocess
 
@@ -10,7 +10,7 @@ DATABASE_NAME = os.environ.get("CLOUDSQL_DATABASE", "data_analysis")
 REGION = os.environ.get("REGION", "asia-southeast1")
 
 def import_sql(event, context):
-    pubsub_message = json.loads(base64.b64decode(event['data']).decode('utf-8'))
+    pubsub_message = orjson.loads(base64.b64decode(event['data']))
     file_name = pubsub_message.get("name")
     bucket_name = pubsub_message.get("bucket")
 
@@ -1,5 +1,5 @@
 import os
-import json
+import orjson
 from google.cloud import bigquery, pubsub_v1
 
 PROJECT_ID = os.environ.get('GCP_PROJECT', 'data-analysis-webapp')
@@ -27,4 +27,4 @@ def process_upload(event, context):
 
     elif file_name.endswith('.sql'):
         message_data = {'name': file_name, 'bucket': bucket_name}
-        publisher.publish(topic_path, data=json.dumps(message_data).encode('utf-8'))
+        publisher.publish(topic_path, data=orjson.dumps(message_data))
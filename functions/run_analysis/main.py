@@ -1,66 +1,64 @@
 import os
+import re
+import functools
 from google.cloud import bigquery, storage
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from google.api_core.exceptions import NotFound
 from flask import Request
 
 PROJECT_ID = os.environ.get('GCP_PROJECT', 'data-analysis-webapp')
 BIGQUERY_DATASET = os.environ.get('BIGQUERY_DATASET', 'analysis_dataset')
 BUCKET_NAME = os.environ.get('BUCKET_NAME', 'data-analysis-upload-1000')
-
-bq_client = bigquery.Client()
-storage_client = storage.Client()
+BIGQUERY_LOCATION = os.environ.get('BIGQUERY_LOCATION', 'asia-southeast1')
+
+# BigQuery can't bind table names as query parameters, so validate before
+# interpolating (same rule as the webapp, so every table it creates passes)
+VALID_TABLE_RE = re.compile(r"^[A-Za-z0-9_]{1,1024}\Z")
+
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 32))
+
+# Both clients share one pooled HTTP session, reused across warm invocations
+credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+http_session = AuthorizedSession(credentials)
+# Transient gateway errors on idempotent calls are retried with backoff; the
+# last response is handed back so the client libraries' own retry logic applies
+HTTP_RETRY = Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504], raise_on_status=False)
+http_session.mount("https://", HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=HTTP_RETRY))
+bq_client = bigquery.Client(credentials=credentials, _http=http_session)
+storage_client = storage.Client(credentials=credentials, _http=http_session)
+
+# Metadata lookups are cached for the life of a warm instance
+@functools.lru_cache(maxsize=256)
+def _dataset_location_cached(dataset_id):
+    return bq_client.get_dataset(dataset_id).location
+
+# Only positive answers are remembered: a table missing now may be created
+# elsewhere (e.g. by a webapp upload) later in this instance's life
+_KNOWN_TABLES = set()
+
+def _table_exists(table_id):
+    if table_id in _KNOWN_TABLES:
+        return True
+    try:
+        bq_client.get_table(table_id)
+    except NotFound:
+        return False
+    _KNOWN_TABLES.add(table_id)
+    return True
 
 def _dataset_location():
     # Read actual dataset location (safer than assuming)
-    ds = bq_client.get_dataset(f"{PROJECT_ID}.{BIGQUERY_DATASET}")
-    return ds.location or BIGQUERY_LOCATION
-
-# Define a fixed schema for Looker Studio table (if needed)
-FIXED_SCHEMA = [
-    bigquery.SchemaField("column1", "STRING"),
-    bigquery.SchemaField("column2", "INTEGER"),
-    bigquery.SchemaField("column3", "FLOAT"),
-    bigquery.SchemaField("column4", "TIMESTAMP")
-]
-
-
-def run_analysis(request: Request):
-    table_name = request.args.get('table')
-    if not table_name:
-        return "Missing 'table' query parameter. Example: ?table=my_table", 400
+    return _dataset_location_cached(f"{PROJECT_ID}.{BIGQUERY_DATASET}") or BIGQUERY_LOCATION
 
-    location = _dataset_location()
-
-    # Query source table
-    query = f"SELECT * FROM `{PROJECT_ID}.{BIGQUERY_DATASET}.{table_name}` LIMIT 10"
-    qcfg = bigquery.QueryJobConfig()
-    qjob = bq_client.query(query, job_config=qcfg, location=location)  # <<< set location
-    results = qjob.result()
-
-    # Write temp CSV to /tmp and upload to GCS (unchanged) …
-
-    # Load results into *_analysis table
-    destination_table = f"{PROJECT_ID}.{BIGQUERY_DATASET}.{table_name}_analysis"
-    load_cfg = bigquery.LoadJobConfig(
-        # if you’re enforcing a schema, keep it here; otherwise use autodetect:
-        autodetect=True,
-        source_format=bigquery.SourceFormat.CSV,
-        skip_leading_rows=1,
-        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
-    )
-    with open(result_file, "rb") as fh:
-        ljob = bq_client.load_table_from_file(fh, destination_table, job_config=load_cfg, location=location)  # <<< set location
-        ljob.result()
-
-    return f"Analysis complete for '{table_name}'. Loaded into {destination_table}."
-    
 def create_table_from_csv_if_not_exists(table_name):
     """Creates a BigQuery table from a CSV in GCS if it doesn't exist."""
     table_ref = bq_client.dataset(BIGQUERY_DATASET).table(table_name)
-    try:
-        bq_client.get_table(table_ref)
+    if _table_exists(f"{PROJECT_ID}.{BIGQUERY_DATASET}.{table_name}"):
         return  # Table already exists
-    except Exception:
-        print(f"Table {table_name} not found. Searching for CSV in GCS...")
+    print(f"Table {table_name} not found. Searching for CSV in GCS...")
 
     # Possible CSV paths
     possible_paths = [
@@ -70,24 +68,30 @@ def create_table_from_csv_if_not_exists(table_name):
         f"raw/{table_name}.csv"
     ]
 
-    bucket = storage_client.bucket(BUCKET_NAME)
-    csv_uri = None
-
-    for path in possible_paths:
-        blob = bucket.blob(path)
-        if blob.exists():
-            csv_uri = f"gs://{BUCKET_NAME}/{path}"
-            print(f"Found CSV at {path}")
-            break
-
-    if not csv_uri:
+    # One server-side filtered listing instead of a HEAD per candidate path
+    names = {
+        blob.name
+        for blob in storage_client.list_blobs(
+            BUCKET_NAME,
+            match_glob="{" + ",".join(possible_paths) + "}",
+            fields="items(name),nextPageToken"
+        )
+    }
+    path = next((p for p in possible_paths if p in names), None)
+
+    if not path:
         raise ValueError(f"No CSV file found in GCS for table {table_name}")
 
-    # Load into BigQuery with autodetect schema
+    csv_uri = f"gs://{BUCKET_NAME}/{path}"
+    print(f"Found CSV at {path}")
+
+    # Load into BigQuery with autodetect schema. WRITE_EMPTY: if the table
+    # appeared in the meantime, fail rather than append a second copy
     job_config = bigquery.LoadJobConfig(
         source_format=bigquery.SourceFormat.CSV,
         skip_leading_rows=1,
-        autodetect=True
+        autodetect=True,
+        write_disposition=bigquery.WriteDisposition.WRITE_EMPTY,
     )
 
     load_job = bq_client.load_table_from_uri(csv_uri, table_ref, job_config=job_config)
@@ -99,39 +103,41 @@ def run_analysis(request: Request):
 
     if not table_name:
         return "Missing 'table' query parameter. Example: ?table=my_table", 400
+    if not VALID_TABLE_RE.fullmatch(table_name):
+        return "Invalid table name. Use letters, numbers, or underscore only.", 400
 
     # Ensure table exists (create if CSV available)
     create_table_from_csv_if_not_exists(table_name)
+    location = _dataset_location()
 
-    # Query first 10 rows
-    query = f"SELECT * FROM `{PROJECT_ID}.{BIGQUERY_DATASET}.{table_name}` LIMIT 10"
-    results = bq_client.query(query).result()
-
-    # Save results to CSV in /tmp
-    result_file = "/tmp/results.csv"
-    with open(result_file, "w") as f:
-        headers = [field.name for field in results.schema]
-        f.write(",".join(headers) + "\n")
-        for row in results:
-            f.write(",".join([str(x) for x in row.values()]) + "\n")
-
-    # Upload analysis results to GCS
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(f"analysis_results/{table_name}_results.csv")
-    blob.upload_from_filename(result_file)
-
-    # Load into fixed-schema BigQuery table for Looker Studio
+    # Materialize the first 10 rows into the *_analysis table server-side (CTAS),
+    # so no rows pass through the function
+    source_table = f"{PROJECT_ID}.{BIGQUERY_DATASET}.{table_name}"
     destination_table = f"{PROJECT_ID}.{BIGQUERY_DATASET}.{table_name}_analysis"
-    job_config = bigquery.LoadJobConfig(
-        schema=FIXED_SCHEMA,
-        source_format=bigquery.SourceFormat.CSV,
-        skip_leading_rows=1,
-        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE
+    query = f"CREATE OR REPLACE TABLE `{destination_table}` AS SELECT * FROM `{source_table}` LIMIT 10"
+    try:
+        bq_client.query(query, location=location).result()
+    except NotFound:
+        # The source table was deleted after this instance cached it: forget
+        # it and fall back to the CSV bootstrap once more
+        _KNOWN_TABLES.discard(source_table)
+        try:
+            create_table_from_csv_if_not_exists(table_name)
+        except ValueError as e:
+            return str(e), 404
+        bq_client.query(query, location=location).result()
+
+    # Export the analysis table to GCS as zstd Parquet (extract job, also server-side)
+    extract_job = bq_client.extract_table(
+        destination_table,
+        f"gs://{BUCKET_NAME}/analysis_results/{table_name}.parquet",
+        job_config=bigquery.ExtractJobConfig(
+            destination_format=bigquery.DestinationFormat.PARQUET,
+            compression=bigquery.Compression.ZSTD
+        ),
+        location=location
     )
-
-    with open(result_file, "rb") as source_file:
-        load_job = bq_client.load_table_from_file(source_file, destination_table, job_config=job_config)
-        load_job.result()
+    extract_job.result()
 
     return (
         f"Analysis complete for table '{table_name}'.\n"
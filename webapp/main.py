@@ -1,18 +1,37 @@
-from flask import Flask, request, render_template, send_file, jsonify, g
+from flask import Flask, Request, request, jsonify, g, Response, stream_with_context, redirect
 import os
-import json
-import csv
-import pandas as pd
+import orjson
 from functools import wraps
 from google.cloud import storage, bigquery
 from google.cloud import pubsub_v1
+from google.cloud import bigquery_storage
+import pyarrow as pa
+import pyarrow.compute as pacompute
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 import re
 import io
+import gzip
+import mimetypes
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import google.auth
+from google.auth.transport.requests import AuthorizedSession, Request as AuthRequest
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from google.api_core.exceptions import NotFound
+from python_calamine import CalamineWorkbook
 
 app = Flask(__name__)
 app.secret_key = "supersecret"  # Needed for flash messages
 
+# index.html has no template variables: render it once at import
+INDEX_HTML = app.jinja_env.get_template('index.html').render()
+
 # ===============================
 # 🔹 IAP-only auth helpers
 # ===============================
@@ -46,41 +65,442 @@ PROJECT_ID = os.environ.get('GCP_PROJECT', 'data-analysis-webapp')
 BUCKET_NAME = os.environ.get('BUCKET_NAME', 'data-analysis-upload-1000')
 PUBSUB_TOPIC_FOR_SQL_IMPORT = os.environ.get('PUBSUB_TOPIC_FOR_SQL_IMPORT', 'sql-import-topic')
 BIGQUERY_DATASET = os.environ.get('BIGQUERY_DATASET', 'analysis_dataset')
-
-# Clients
-storage_client = storage.Client()
-bq_client = bigquery.Client()
-publisher = pubsub_v1.PublisherClient()
+BIGQUERY_LOCATION = os.environ.get('BIGQUERY_LOCATION', 'asia-southeast1')  # Match your region
+TABLE_PREFIX = f"{PROJECT_ID}.{BIGQUERY_DATASET}"
+# \Z rather than $: a trailing newline must not pass as a valid name
+VALID_TABLE_RE = re.compile(r"^[A-Za-z0-9_]{1,1024}\Z")
+
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 32))
+
+# Objects up to this size go to GCS in a single request (the client's
+# multipart limit); larger ones use resumable uploads with these chunk sizes
+SINGLE_REQUEST_UPLOAD_MAX = 8 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 32 * 1024 * 1024   # user uploads
+RESULT_CHUNK_SIZE = 32 * 1024 * 1024   # analysis result artifacts
+# Uploads are verified with CRC32C (computed by the google-crc32c C extension)
+UPLOAD_CHECKSUM = "crc32c"
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024  # streamed GCS downloads
+
+# Browsers may reuse a downloaded analysis artifact briefly (GCS adds
+# ETag/Last-Modified, so later repeats revalidate with a 304)
+RESULT_CACHE_CONTROL = "private, max-age=60"
+
+# Parallel composite uploads for large in-memory payloads
+GCS_MULTIPART_THRESHOLD = int(os.environ.get('GCS_MULTIPART_THRESHOLD', 150 * 1024 * 1024))
+GCS_MULTIPART_CHUNKSIZE = int(os.environ.get('GCS_MULTIPART_CHUNKSIZE', 32 * 1024 * 1024))
+GCS_MAX_CONCURRENCY = int(os.environ.get('GCS_MAX_CONCURRENCY', 16))
+
+# Arrow CSV writer options, built once per process and shared by all requests
+CSV_WRITE_OPTIONS = pacsv.WriteOptions(include_header=True)
+CSV_APPEND_OPTIONS = pacsv.WriteOptions(include_header=False)
+
+# Result rows are exported one chunk at a time so memory stays O(chunk):
+# rows per REST page, and how many Storage API batches may be buffered
+ROWS_PER_CHUNK = int(os.environ.get('ROWS_PER_CHUNK', 100_000))
+ARROW_MAX_QUEUE_SIZE = 4
+
+# Clients (GCS + BigQuery share one pooled HTTP session sized for the
+# number of concurrent requests an instance serves)
+credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+http_session = AuthorizedSession(credentials)
+# Transient gateway errors on idempotent calls are retried with backoff; the
+# last response is handed back so the client libraries' own retry logic applies
+HTTP_RETRY = Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504], raise_on_status=False)
+http_session.mount("https://", HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=HTTP_RETRY))
+storage_client = storage.Client(credentials=credentials, _http=http_session)
+# Every query reuses cached results when the inputs are unchanged and is
+# labelled for billing/monitoring
+bq_client = bigquery.Client(
+    credentials=credentials,
+    _http=http_session,
+    default_query_job_config=bigquery.QueryJobConfig(
+        use_query_cache=True,
+        use_legacy_sql=False,
+        labels={"app": "webapp"},
+    ),
+)
+bqstorage_client = bigquery_storage.BigQueryReadClient(credentials=credentials)
+BUCKET = storage_client.bucket(BUCKET_NAME)
+# One message per upload: send it immediately instead of waiting to fill a batch
+publisher = pubsub_v1.PublisherClient(
+    batch_settings=pubsub_v1.types.BatchSettings(max_messages=1, max_latency=0.01)
+)
 topic_path = publisher.topic_path(PROJECT_ID, PUBSUB_TOPIC_FOR_SQL_IMPORT)
 
+# Post-upload analysis runs here so the upload POST returns once the data is
+# loaded; clients poll /status/<task_id> for the outcome
+_executor = ThreadPoolExecutor(max_workers=8)
+# Work a request thread waits on (Excel archive uploads) gets its own pool, so
+# upload latency never depends on how many analyses are queued above
+_request_executor = ThreadPoolExecutor(max_workers=4)
+TASK_TTL = 600  # seconds a finished task waits to be polled before it is dropped
+_tasks = {}  # task_id -> (started_at, Future)
+
+def _submit_task(table_name: str, fn, *args, **kwargs) -> str:
+    """Run fn in the background and return an id that /status can resolve.
+
+    The id carries the table and start time so an instance that did not run
+    the task can still answer from BigQuery.
+    """
+    now = time.time()
+    for task_id, (started_at, future) in list(_tasks.items()):
+        if future.done() and now - started_at > TASK_TTL:
+            _tasks.pop(task_id, None)
+    task_id = f"{table_name}.{int(now * 1000)}.{uuid.uuid4().hex[:8]}"
+    _tasks[task_id] = (now, _executor.submit(fn, *args, **kwargs))
+    return task_id
+
+def _warm_up():
+    """Refresh credentials and open a pooled GCS connection off the request path."""
+    try:
+        BUCKET.exists(timeout=10)
+    except Exception as e:
+        print(f"Warm-up request failed: {e}")
+
+# Flask 3 dropped before_first_request; each worker warms up once at import,
+# on a daemon thread so a stalled warm-up never holds up startup or shutdown
+threading.Thread(target=_warm_up, daemon=True).start()
+
 # ===============================
 # 🔹 Helper functions
 # ===============================
+def _fq_table(table_name: str) -> str:
+    """Return fully-qualified table id, after validating a safe table name."""
+    if not VALID_TABLE_RE.match(table_name):
+        raise ValueError("Invalid table name. Use letters, numbers, or underscore only.")
+    return f"{TABLE_PREFIX}.{table_name}"
+
+# Datasets already ensured by this process; set.add is atomic under the GIL
+_DATASET_OK = set()
+
 def ensure_dataset_exists(dataset_id):
-    """Create dataset if it doesn't already exist."""
-    dataset_ref = bq_client.dataset(dataset_id)
+    """Create dataset if it doesn't already exist (one idempotent DDL call per process)."""
+    if dataset_id in _DATASET_OK:
+        return
+    bq_client.query_and_wait(
+        f"CREATE SCHEMA IF NOT EXISTS `{PROJECT_ID}.{dataset_id}` "
+        f"OPTIONS(location='{BIGQUERY_LOCATION}')",
+        location=BIGQUERY_LOCATION
+    )
+    _DATASET_OK.add(dataset_id)
+
+# Table metadata for schema lookups, kept briefly so repeated report and
+# Looker calls on the same table skip the get_table round-trip
+TABLE_CACHE_TTL = 60  # seconds
+_table_cache = {}  # table_id -> (expires_at, Table)
+
+def _get_table(table_id):
+    """get_table with a short per-process TTL cache."""
+    now = time.monotonic()
+    hit = _table_cache.get(table_id)
+    if hit and hit[0] > now:
+        return hit[1]
+    table = bq_client.get_table(table_id)
+    _table_cache[table_id] = (now + TABLE_CACHE_TTL, table)
+    return table
+
+# /run_report responses, so a report polled repeatedly (e.g. by Looker
+# Studio) skips BigQuery entirely for a short while
+REPORT_CACHE_TTL = 60  # seconds
+REPORT_CACHE_MAX = 128  # entries; results can be up to `limit` rows each
+_report_cache = OrderedDict()  # (report_id, table, limit) -> (expires_at, columns, rows)
+_report_cache_lock = threading.Lock()
+
+def _cache_report(key, columns, rows):
+    """Store a report result, dropping expired entries and then the oldest."""
+    now = time.monotonic()
+    with _report_cache_lock:
+        for k in [k for k, v in _report_cache.items() if v[0] <= now]:
+            del _report_cache[k]
+        _report_cache[key] = (now + REPORT_CACHE_TTL, columns, rows)
+        _report_cache.move_to_end(key)
+        while len(_report_cache) > REPORT_CACHE_MAX:
+            _report_cache.popitem(last=False)
+
+def _invalidate():
+    """Drop cached lookups after a write path created or replaced a table."""
+    _table_cache.clear()
+    with _report_cache_lock:
+        _report_cache.clear()
+
+def _csv_stream(results):
+    """
+    Yield CSV bytes one Arrow record batch at a time as BigQuery returns
+    pages, so memory stays O(page) and the first rows go out immediately.
+    """
+    options = CSV_WRITE_OPTIONS
+    for batch in results.to_arrow_iterable(bqstorage_client=bqstorage_client, max_queue_size=ARROW_MAX_QUEUE_SIZE):
+        buf = io.BytesIO()
+        pacsv.write_csv(batch, buf, write_options=options)
+        options = CSV_APPEND_OPTIONS
+        yield buf.getvalue()
+    if options is CSV_WRITE_OPTIONS:
+        # Empty result: still send the header row
+        yield (",".join(f'"{f.name}"' for f in results.schema) + "\n").encode("utf-8")
+
+def _csv_response(results, download_name):
+    """Stream a RowIterator to the client as a CSV attachment."""
+    return Response(
+        stream_with_context(_csv_stream(results)),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{download_name}"'}
+    )
+
+def _stream_blob(blob, download_name, mimetype="text/csv"):
+    """Stream a GCS object to the client as it is read (no /tmp copy)."""
+    def generate():
+        with blob.open("rb", chunk_size=DOWNLOAD_CHUNK_SIZE) as fh:
+            while chunk := fh.read(1 << 20):
+                yield chunk
+
+    headers = {
+        "Content-Disposition": f'attachment; filename="{download_name}"',
+        "Cache-Control": RESULT_CACHE_CONTROL,
+    }
+    if blob.size is not None:
+        headers["Content-Length"] = str(blob.size)
+    return Response(stream_with_context(generate()), mimetype=mimetype, headers=headers)
+
+def _log_publish_error(future):
+    """Done-callback for fire-and-forget publishes; failures only reach the logs."""
+    exc = future.exception()
+    if exc:
+        print(f"Pub/Sub publish failed: {exc}")
+
+def _signed_url(blob, download_name, expiration=timedelta(minutes=10)):
+    """
+    V4 signed GET URL for a blob. Passing the service account email + token
+    makes the client sign through IAM signBlob, which also works with the
+    key-less Cloud Run credentials (the runtime service account needs
+    roles/iam.serviceAccountTokenCreator on itself). Returns None when the
+    credentials are not a service account, e.g. user ADC in local dev.
+    """
+    if not credentials.valid:
+        credentials.refresh(AuthRequest())
+    service_account_email = getattr(credentials, "service_account_email", None)
+    if not service_account_email:
+        return None
+    return blob.generate_signed_url(
+        version="v4",
+        expiration=expiration,
+        method="GET",
+        response_disposition=f'attachment; filename="{download_name}"',
+        service_account_email=service_account_email,
+        access_token=credentials.token,
+    )
+
+# ===============================
+# 🔹 Streaming uploads (multipart → GCS)
+# ===============================
+# Uploads BigQuery can load straight from GCS are streamed into the bucket
+# while Werkzeug parses the multipart body, instead of being spooled to /tmp
+DIRECT_UPLOAD_EXTS = {".sql", ".csv", ".json", ".parquet"}
+# Workbooks are parsed whole on this instance, so they are buffered in
+# memory rather than spooled to /tmp and read back
+EXCEL_UPLOAD_EXTS = {".xls", ".xlsx"}
+# With BQ_LOAD_GZIP=1, text formats are gzipped on the way in (stored with
+# Content-Encoding: gzip, which BigQuery loads as-is); level 1 keeps the CPU
+# cost low. Off by default: BigQuery reads gzipped CSV/JSON single-threaded,
+# which only pays off when the upload link, not the load, is the bottleneck.
+# Bodies over BigQuery's 4 GB gzip cap always stay uncompressed
+BQ_LOAD_GZIP = os.environ.get('BQ_LOAD_GZIP', '0') == '1'
+GZIP_UPLOAD_EXTS = {".csv", ".json"}
+GZIP_LEVEL = 1
+GZIP_MAX_BYTES = 4 * 1000 ** 3
+
+class _BlobUpload(io.RawIOBase):
+    """
+    Write-only sink Werkzeug spools a file part into. Bytes go straight to a
+    GCS BlobWriter; Werkzeug rewinds the container once the part is complete,
+    which is where the upload is finalized. A part that never completes (the
+    client went away) is abandoned, so it cannot replace a good object.
+    """
+    def __init__(self, blob, content_type, compress=False):
+        super().__init__()
+        self.blob = blob
+        if compress:
+            blob.content_encoding = "gzip"
+        self._raw = blob.open("wb", content_type=content_type, checksum=UPLOAD_CHECKSUM)
+        self._writer = gzip.GzipFile(fileobj=self._raw, mode="wb", compresslevel=GZIP_LEVEL) if compress else self._raw
+        self._complete = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self._writer.write(data)
+
+    def _finish(self):
+        # GzipFile.close() leaves the underlying writer open
+        if not self._writer.closed:
+            self._writer.close()
+        if not self._raw.closed:
+            self._raw.close()
+
+    def _abandon(self):
+        # BlobWriter.close() would commit what arrived so far; close its
+        # buffer instead, which drops the resumable session unfinalized
+        self._raw._buffer.close()
+        if self._writer is not self._raw:
+            try:
+                self._writer.close()
+            except ValueError:  # the gzip trailer has nowhere to go
+                pass
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._complete = True
+        self._finish()
+        return 0
+
+    def close(self):
+        # Also reached from IOBase.__del__ when Werkzeug drops a partial part
+        if self._complete:
+            self._finish()
+        elif not self._raw.closed:
+            self._abandon()
+        super().close()
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        ext = os.path.splitext(filename or "")[1].lower()
+        if total_content_length is not None and total_content_length <= SINGLE_REQUEST_UPLOAD_MAX:
+            # Small body: buffer it and send it to GCS in one request later,
+            # rather than paying a resumable session for a few KB
+            return io.BytesIO()
+        if ext in DIRECT_UPLOAD_EXTS:
+            blob = BUCKET.blob(f"uploads/{filename}", chunk_size=UPLOAD_CHUNK_SIZE)
+            compress = (
+                BQ_LOAD_GZIP
+                and ext in GZIP_UPLOAD_EXTS
+                and (total_content_length or 0) < GZIP_MAX_BYTES
+            )
+            return _BlobUpload(blob, content_type, compress=compress)
+        if ext in EXCEL_UPLOAD_EXTS:
+            return io.BytesIO()
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+app.request_class = UploadRequest
+
+def _composite_upload(blob, data, content_type=None):
+    """
+    Upload `data` as parts on a thread pool, then compose them into `blob`
+    server-side and drop the parts. GCS composes at most 32 sources.
+    """
+    view = memoryview(data)
+    part_size = max(GCS_MULTIPART_CHUNKSIZE, -(-len(view) // 32))
+    offsets = range(0, len(view), part_size)
+    parts = [blob.bucket.blob(f"{blob.name}.part-{i:02d}") for i in range(len(offsets))]
+
+    def _put(part, offset):
+        part.upload_from_file(
+            io.BytesIO(view[offset:offset + part_size]), content_type=content_type, checksum=UPLOAD_CHECKSUM
+        )
+
+    with ThreadPoolExecutor(max_workers=GCS_MAX_CONCURRENCY) as pool:
+        list(pool.map(_put, parts, offsets))
+
+    blob.content_type = content_type
+    blob.compose(parts)
+    blob.bucket.delete_blobs(parts)
+
+def _upload_source(source, filename, content_type=None):
+    """Return the uploads/ blob for `source`, uploading it unless it was already streamed to GCS."""
+    if isinstance(source, _BlobUpload):
+        return source.blob
+    blob = BUCKET.blob(f"uploads/{filename}")
+    size = source.seek(0, io.SEEK_END)
+    source.seek(0)
+    if isinstance(source, io.BytesIO) and size >= GCS_MULTIPART_THRESHOLD:
+        _composite_upload(blob, source.getbuffer(), content_type)
+    else:
+        if size > SINGLE_REQUEST_UPLOAD_MAX:
+            blob.chunk_size = UPLOAD_CHUNK_SIZE
+        blob.upload_from_file(source, size=size, content_type=content_type, checksum=UPLOAD_CHECKSUM)
+    return blob
+
+def _arrow_column(values):
+    """Build one Arrow column from a list of Excel cell values."""
     try:
-        bq_client.get_dataset(dataset_ref)
-    except Exception:
-        dataset = bigquery.Dataset(dataset_ref)
-        dataset.location = "asia-southeast1"  # Match your region
-        bq_client.create_dataset(dataset)
-
-def load_to_bigquery(file_path, filename, table_name):
-    """Loads supported file types into BigQuery with autodetect schema."""
+        arr = pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Mixed-type column: keep every cell as text
+        return pa.array([
+            None if v is None else str(int(v)) if isinstance(v, float) and v.is_integer() else str(v)
+            for v in values
+        ], pa.string())
+    if pa.types.is_null(arr.type):
+        return arr.cast(pa.string())
+    # calamine reports whole numbers as floats; restore integer columns
+    if pa.types.is_floating(arr.type) and pacompute.all(pacompute.equal(arr, pacompute.floor(arr))).as_py():
+        try:
+            return arr.cast(pa.int64())
+        except pa.ArrowInvalid:
+            pass
+    return arr
+
+def _excel_column_name(value, index):
+    """Turn an Excel header cell into a BigQuery-safe column name."""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)  # a year header reads back as 2024.0
+    name = re.sub(r"[^0-9A-Za-z_]", "_", str(value).strip())
+    return name or f"column_{index}"
+
+def _excel_to_arrow(source):
+    """
+    Read the first sheet of an Excel workbook into an Arrow table. Cell values
+    go column-wise from calamine into Arrow arrays, without a pandas DataFrame.
+    """
+    rows = CalamineWorkbook.from_filelike(source).get_sheet_by_index(0).to_python(skip_empty_area=True)
+    if not rows:
+        raise ValueError("The Excel sheet is empty.")
+
+    header, body = rows[0], rows[1:]
+    columns, seen = {}, set()
+    for i, name in enumerate(header):
+        name = _excel_column_name(name, i)
+        # BigQuery column names are case-insensitive
+        base, n = name, i
+        while name.lower() in seen:
+            name = f"{base}_{n}"
+            n += 1
+        seen.add(name.lower())
+        columns[name] = _arrow_column([None if row[i] == "" else row[i] for row in body])
+    return pa.table(columns)
+
+def load_to_bigquery(source, filename, table_name):
+    """
+    Loads supported file types into BigQuery with autodetect schema.
+    `source` is a readable binary file object (e.g. the uploaded file stream).
+    """
     ensure_dataset_exists(BIGQUERY_DATASET)
 
     ext = os.path.splitext(filename)[1].lower()
-    tmp_path = file_path
 
-    # Convert Excel to CSV before loading
+    # Excel has to be parsed on this instance anyway: convert it to Parquet in
+    # memory and load that straight into BigQuery, while the original upload
+    # is archived to GCS in the background
     if ext in [".xls", ".xlsx"]:
-        df = pd.read_excel(file_path)
-        tmp_path = f"/tmp/{table_name}.csv"
-        df.to_csv(tmp_path, index=False)
-        source_format = bigquery.SourceFormat.CSV
-        skip_rows = 1
-    elif ext == ".csv":
+        data = source.read()
+        archived = _request_executor.submit(
+            _upload_source, io.BytesIO(data), filename, mimetypes.guess_type(filename)[0]
+        )
+        parquet_buf = io.BytesIO()
+        pq.write_table(_excel_to_arrow(io.BytesIO(data)), parquet_buf, compression="zstd", compression_level=3)
+        parquet_buf.seek(0)
+        load_job = bq_client.load_table_from_file(
+            parquet_buf,
+            f"{TABLE_PREFIX}.{table_name}",
+            job_config=bigquery.LoadJobConfig(
+                source_format=bigquery.SourceFormat.PARQUET,
+                write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+            ),
+        )
+        load_job.result()
+        archived.result()
+        _invalidate()
+        return
+
+    if ext == ".csv":
         source_format = bigquery.SourceFormat.CSV
         skip_rows = 1
     elif ext == ".json":
@@ -92,13 +512,7 @@ def load_to_bigquery(file_path, filename, table_name):
     else:
         raise ValueError("Unsupported file type. Use CSV, Excel, JSON, or Parquet.")
 
-    # Upload to GCS
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(f"uploads/{filename}")
-    blob.upload_from_filename(tmp_path)
-
-    # Load into BigQuery
-    table_id = f"{PROJECT_ID}.{BIGQUERY_DATASET}.{table_name}"
+    table_id = f"{TABLE_PREFIX}.{table_name}"
     job_config = bigquery.LoadJobConfig(
         autodetect=True,
         source_format=source_format,
@@ -106,60 +520,76 @@ def load_to_bigquery(file_path, filename, table_name):
         write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
     )
 
-    with open(tmp_path, "rb") as source_file:
-        load_job = bq_client.load_table_from_file(source_file, table_id, job_config=job_config)
-
+    # Upload to GCS, then let BigQuery ingest straight from the bucket
+    # instead of streaming the same bytes through this instance again
+    blob = _upload_source(source, filename, content_type=mimetypes.guess_type(filename)[0])
+    load_job = bq_client.load_table_from_uri(
+        f"gs://{BUCKET_NAME}/{blob.name}", table_id, job_config=job_config
+    )
     load_job.result()
+    _invalidate()
 
-def run_analysis(table_name):
-    """Runs a fresh analysis query, saves results to GCS and BigQuery."""
-    ensure_dataset_exists(BIGQUERY_DATASET)
-
-    try:
-        bq_client.get_table(f"{PROJECT_ID}.{BIGQUERY_DATASET}.{table_name}")
-    except Exception:
-        raise ValueError(f"BigQuery table {table_name} not found.")
+# table_name -> (modified, num_rows) of the source table when its analysis
+# results were last known to be current on this instance
+analysis_cache = {}
 
-    query = f"SELECT * FROM `{PROJECT_ID}.{BIGQUERY_DATASET}.{table_name}` LIMIT 10"
-    results = bq_client.query(query).result()
-
-    local_csv = f"/tmp/{table_name}_results.csv"
-    with open(local_csv, "w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.writer(csvfile)
-        headers = [field.name for field in results.schema]
-        writer.writerow(headers)
-        for row in results:
-            writer.writerow(list(row.values()))
-
-    # Upload to GCS
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(f"analysis_results/{table_name}_results.csv")
-    blob.upload_from_filename(local_csv)
+def run_analysis(table_name, *, export=True):
+    """
+    Runs a fresh analysis query, saves results to BigQuery and, unless
+    export=False, to GCS as Parquet. Returns the uploaded blob (None when
+    not exporting).
+    """
+    table_fq = _fq_table(table_name)
+    ensure_dataset_exists(BIGQUERY_DATASET)
 
-    # Save to BigQuery _analysis table
-    destination_table = f"{PROJECT_ID}.{BIGQUERY_DATASET}.{table_name}_analysis"
+    # Single query: BigQuery saves to the _analysis table and we read the
+    # same job's rows for the GCS artifact
+    query = f"SELECT * FROM `{table_fq}` LIMIT 10"
+    destination_table = f"{TABLE_PREFIX}.{table_name}_analysis"
     job_config = bigquery.QueryJobConfig(
         destination=destination_table,
         write_disposition="WRITE_TRUNCATE"
     )
-    bq_client.query(query, job_config=job_config).result()
+    # No get_table precheck: a missing source table surfaces as NotFound
+    try:
+        results = bq_client.query(query, job_config=job_config).result(page_size=ROWS_PER_CHUNK)
+    except NotFound:
+        raise ValueError(f"BigQuery table {table_name} not found.")
+    _invalidate()  # the destination table may have just been created
+    if not export:
+        return None
+
+    # Write the rows as zstd Parquet, one row group per Arrow batch. The
+    # artifact is small (LIMIT 10), so it is built in memory and usually goes
+    # to GCS in a single request instead of a resumable session
+    sink = io.BytesIO()
+    writer = None
+    for batch in results.to_arrow_iterable(bqstorage_client=bqstorage_client, max_queue_size=ARROW_MAX_QUEUE_SIZE):
+        if writer is None:
+            writer = pq.ParquetWriter(sink, batch.schema, compression="zstd", compression_level=3)
+        writer.write_batch(batch)
+    if writer is None:
+        # Empty result: still write a valid file with the column names
+        pq.write_table(pa.table({f.name: pa.nulls(0) for f in results.schema}), sink)
+    else:
+        writer.close()
 
-    return table_name
+    size = sink.tell()
+    sink.seek(0)
+    blob = BUCKET.blob(f"analysis_results/{table_name}.parquet")
+    blob.cache_control = RESULT_CACHE_CONTROL
+    if size > SINGLE_REQUEST_UPLOAD_MAX:
+        blob.chunk_size = RESULT_CHUNK_SIZE
+    blob.upload_from_file(sink, size=size, content_type="application/octet-stream", checksum=UPLOAD_CHECKSUM)
+
+    return blob
 
 # ===============================
 # 🔹 Auto-detect finance column names
 # ===============================
-VALID_TABLE_RE = re.compile(r"^[A-Za-z0-9_]+$")
-
-def _fq_table(table_name: str) -> str:
-    """Return fully-qualified table id, after validating a safe table name."""
-    if not VALID_TABLE_RE.match(table_name):
-        raise ValueError("Invalid table name. Use letters, numbers, or underscore only.")
-    return f"{PROJECT_ID}.{BIGQUERY_DATASET}.{table_name}"
-
 def _table_schema_cols(table_fq: str):
     """Return dict {lower_col_name: (original_name, field)}."""
-    tbl = bq_client.get_table(table_fq)
+    tbl = _get_table(table_fq)
     out = {}
     for f in tbl.schema:
         out[f.name.lower()] = (f.name, f)
@@ -256,9 +686,25 @@ REPORTS = {
     },
 }
 
+def _report_sql(report_id: str, table_fq: str) -> str:
+    """
+    Report SQL for a table, with its finance columns filled in. The text is
+    stable per table, so repeated view DDL and queries match BigQuery's caches.
+    The schema comes from _get_table, so a replaced table is picked up within
+    TABLE_CACHE_TTL on every instance.
+    """
+    cols = _detect_finance_columns(table_fq)
+    return REPORTS[report_id]["sql"].format(
+        table_fq=table_fq,
+        department=cols["department"],
+        amount=cols["amount"],
+        date=cols["date"],
+        expense_type=cols["expense_type"] or "NULL",
+    )
+
 def _run_sql(sql: str, max_rows: int = 1000):
-    job = bq_client.query(sql)
-    result = job.result(max_results=max_rows)
+    # jobs.query answers short queries in a single round-trip (no job polling)
+    result = bq_client.query_and_wait(sql, max_results=max_rows)
     columns = [f.name for f in result.schema]
     rows = [list(row.values()) for row in result]
     return columns, rows
@@ -279,7 +725,9 @@ def _create_or_replace_view(view_id: str, sql: str):
     except NotFound:
         table = bigquery.Table(view_id)
         table.view_query = sql
-        return bq_client.create_table(table)
+        created = bq_client.create_table(table)
+        _invalidate()
+        return created
 
 def publish_looker_views_for_table(table_name: str) -> dict:
     """
@@ -287,27 +735,20 @@ def publish_looker_views_for_table(table_name: str) -> dict:
       <table>__<report_id>_v  (e.g., finance_data__dept_totals_v)
     Returns dict {report_id: fully_qualified_view_id}
     """
+    table_fq = _fq_table(table_name)
     ensure_dataset_exists(BIGQUERY_DATASET)
-    if not VALID_TABLE_RE.match(table_name):
-        raise ValueError("Invalid table name. Use letters, numbers, or underscore only.")
-
-    table_fq = f"{PROJECT_ID}.{BIGQUERY_DATASET}.{table_name}"
-    cols = _detect_finance_columns(table_fq)
 
-    created = {}
-    for rid, meta in REPORTS.items():
+    created, view_sql = {}, {}
+    for rid in REPORTS:
         view_name = f"{table_name}__{rid}_v"
-        view_fq = f"{PROJECT_ID}.{BIGQUERY_DATASET}.{view_name}"
-        sql = meta["sql"].format(
-            table_fq=table_fq,
-            department=cols["department"],
-            amount=cols["amount"],
-            date=cols["date"],
-            expense_type=cols["expense_type"] or "NULL",
-        )
-        _create_or_replace_view(view_fq, sql)
+        view_fq = f"{TABLE_PREFIX}.{view_name}"
+        view_sql[view_fq] = _report_sql(rid, table_fq)
         created[rid] = view_fq
 
+    # Views are independent: issue their get/update/create round-trips concurrently
+    with ThreadPoolExecutor(max_workers=len(view_sql)) as pool:
+        list(pool.map(_create_or_replace_view, view_sql.keys(), view_sql.values()))
+
     return created
 
 # ===============================
@@ -322,60 +763,99 @@ def index():
         uploaded_file = request.files.get('file')
         if uploaded_file:
             file_ext = os.path.splitext(uploaded_file.filename)[1].lower()
-            file_path = f"/tmp/{uploaded_file.filename}"
-            uploaded_file.save(file_path)
 
             table_name = os.path.splitext(uploaded_file.filename)[0].replace(" ", "_").lower()
+            if not VALID_TABLE_RE.match(table_name):
+                return jsonify({
+                    "success": False,
+                    "error": "Invalid file name. Use letters, numbers, spaces, or underscore only.",
+                }), 400
 
             try:
                 if file_ext == '.sql':
                     # Upload raw SQL to GCS then notify Pub/Sub
-                    bucket = storage_client.bucket(BUCKET_NAME)
-                    blob = bucket.blob(f"uploads/{uploaded_file.filename}")
-                    blob.upload_from_filename(file_path)
+                    _upload_source(uploaded_file.stream, uploaded_file.filename, content_type=uploaded_file.mimetype)
 
                     message_data = {'name': uploaded_file.filename, 'bucket': BUCKET_NAME}
-                    publisher.publish(topic_path, data=json.dumps(message_data).encode('utf-8'))
-
-                elif file_ext in ['.xlsx', '.xls']:
-                    # Convert Excel to CSV first
-                    csv_path = f"/tmp/{table_name}.csv"
-                    df = pd.read_excel(file_path)
-                    df.to_csv(csv_path, index=False)
-                    load_to_bigquery(csv_path, f"{table_name}.csv", table_name)
+                    future = publisher.publish(topic_path, data=orjson.dumps(message_data))
+                    future.add_done_callback(_log_publish_error)
 
-                elif file_ext in ['.csv', '.json', '.parquet']:
-                    load_to_bigquery(file_path, uploaded_file.filename, table_name)
+                elif file_ext in ['.csv', '.json', '.parquet', '.xlsx', '.xls']:
+                    load_to_bigquery(uploaded_file.stream, uploaded_file.filename, table_name)
 
                 else:
                     return jsonify({"success": False, "error": "Unsupported file format."}), 400
 
-                # Run downstream analysis
-                run_analysis(table_name)
+                # Refresh the _analysis table in the background; the Parquet
+                # artifact is only built when /download_bq asks for it
+                task_id = _submit_task(table_name, run_analysis, table_name, export=False)
                 return jsonify({
                     "success": True,
-                    "message": f"✅ Uploaded {uploaded_file.filename} and analysis complete",
+                    "message": f"✅ Uploaded {uploaded_file.filename}, analysis running",
                     "table": table_name,
-                    "user": user_email
-                })
+                    "user": user_email,
+                    "task_id": task_id,
+                }), 202
 
             except Exception as e:
                 return jsonify({"success": False, "error": str(e)}), 500
 
-    return render_template('index.html')
+    return INDEX_HTML
+
+def _task_status_from_bigquery(task_id: str):
+    """Answer for a task started on another instance: it is done once the
+    table's _analysis result was rewritten after the task started."""
+    try:
+        table_name, started_ms, _ = task_id.split(".")
+        started = datetime.fromtimestamp(int(started_ms) / 1000, timezone.utc)
+        table_fq = _fq_table(table_name)
+    except ValueError:
+        return jsonify({"success": False, "error": "Unknown task."}), 404
+
+    try:
+        analysis = bq_client.get_table(f"{table_fq}_analysis")
+    except NotFound:
+        analysis = None
+    if analysis is not None and analysis.modified and analysis.modified >= started:
+        return jsonify({"success": True, "state": "done"})
+    if datetime.now(timezone.utc) - started > timedelta(seconds=TASK_TTL):
+        return jsonify({"success": False, "state": "failed", "error": "Analysis did not finish."}), 500
+    return jsonify({"success": True, "state": "running"})
+
+@app.route('/status/<task_id>')
+@require_user
+def task_status(task_id):
+    entry = _tasks.get(task_id)
+    if entry is None:
+        return _task_status_from_bigquery(task_id)
+    future = entry[1]
+    if not future.done():
+        return jsonify({"success": True, "state": "running"})
+
+    # Finished tasks are reported once, then forgotten
+    _tasks.pop(task_id, None)
+    exc = future.exception()
+    if exc:
+        return jsonify({"success": False, "state": "failed", "error": str(exc)}), 500
+    return jsonify({"success": True, "state": "done"})
 
 @app.route('/download/<filename>')
 @require_user
 def download_file(filename):
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(f"analysis_results/{filename}")
+    blob = BUCKET.blob(f"analysis_results/{filename}")
 
-    if not blob.exists():
-        return f"File {filename} not found in analysis_results folder.", 404
+    # Let the browser pull the object from GCS instead of proxying it. No
+    # exists() round-trip first: GCS itself answers 404 for a missing object
+    url = _signed_url(blob, filename, expiration=timedelta(minutes=15))
+    if url:
+        return redirect(url)
 
-    temp_path = f"/tmp/{filename}"
-    blob.download_to_filename(temp_path)
-    return send_file(temp_path, mimetype='text/csv', as_attachment=True, download_name=filename)
+    # Credentials that cannot sign: proxy the object instead
+    blob = BUCKET.get_blob(f"analysis_results/{filename}")
+    if blob is None:
+        return f"File {filename} not found in analysis_results folder.", 404
+    mimetype = "text/csv" if filename.endswith(".csv") else "application/octet-stream"
+    return _stream_blob(blob, filename, mimetype=mimetype)
 
 @app.route('/download_bq')
 @require_user
@@ -383,24 +863,72 @@ def download_bq():
     table_name = request.args.get("table")
     if not table_name:
         return "Missing ?table parameter.", 400
-
     try:
-        run_analysis(table_name)
+        table_fq = _fq_table(table_name)
     except ValueError as e:
         return str(e), 400
 
-    query = f"SELECT * FROM `{PROJECT_ID}.{BIGQUERY_DATASET}.{table_name}_analysis`"
-    results = bq_client.query(query).result()
+    try:
+        source = bq_client.get_table(table_fq)
+    except NotFound:
+        return f"BigQuery table {table_name} not found.", 400
 
-    temp_path = f"/tmp/{table_name}_analysis.csv"
-    with open(temp_path, "w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.writer(csvfile)
-        headers = [field.name for field in results.schema]
-        writer.writerow(headers)
-        for row in results:
-            writer.writerow(list(row.values()))
+    # JSON clients (XHR / Looker) only want the rows: skip the CSV, GCS and
+    # _analysis side effects, and read the rows with tabledata.list (no query job)
+    if request.args.get("format") == "json" or request.accept_mimetypes.best == "application/json":
+        result = bq_client.list_rows(source, max_results=10)
+        columns = [f.name for f in result.schema]
+        rows = [list(row.values()) for row in result]
+        return jsonify({
+            "success": True,
+            "columns": columns,
+            "rows": rows,
+            "row_count": len(rows)
+        })
 
-    return send_file(temp_path, mimetype='text/csv', as_attachment=True, download_name=f"{table_name}_analysis.csv")
+    # CSV for legacy downloaders: read the _analysis table back (no query).
+    # It is fresh when rewritten after the source changed, which the upload's
+    # background analysis already did, so only refresh it (without the
+    # Parquet export) when it is missing or stale
+    if request.args.get("format") == "csv":
+        analysis_fq = f"{table_fq}_analysis"
+        try:
+            analysis = bq_client.get_table(analysis_fq)
+        except NotFound:
+            analysis = None
+        if analysis is None or analysis.modified < source.modified:
+            try:
+                run_analysis(table_name, export=False)
+            except ValueError as e:
+                return str(e), 400
+            analysis = analysis_fq  # refreshed: list_rows fetches the new schema
+        # A Table carries its schema, so list_rows skips another get_table
+        rows = bq_client.list_rows(analysis, page_size=ROWS_PER_CHUNK)
+        return _csv_response(rows, f"{table_name}_analysis.csv")
+
+    # Only re-run the analysis when the source table changed since the last
+    # run: check this instance's fingerprint first, then the GCS artifact's age
+    fingerprint = (source.modified, source.num_rows)
+    result_name = f"analysis_results/{table_name}.parquet"
+    if analysis_cache.get(table_name) == fingerprint:
+        blob, fresh = BUCKET.blob(result_name), True
+    else:
+        blob = BUCKET.get_blob(result_name)
+        fresh = blob is not None and blob.updated >= source.modified
+    if not fresh:
+        try:
+            # The returned blob carries its metadata (size) from the upload
+            blob = run_analysis(table_name)
+        except ValueError as e:
+            return str(e), 400
+    analysis_cache[table_name] = fingerprint
+
+    # Fresh results: let GCS serve them directly; otherwise (or when the
+    # credentials cannot sign) stream what run_analysis just wrote
+    url = _signed_url(blob, f"{table_name}_analysis.parquet") if fresh else None
+    if url:
+        return redirect(url)
+    return _stream_blob(blob, f"{table_name}_analysis.parquet", mimetype="application/octet-stream")
 
 @app.route("/whoami")
 @require_user
@@ -438,16 +966,14 @@ def run_report():
         return jsonify({"success": False, "error": "Missing 'table'."}), 400
 
     try:
-        table_fq = _fq_table(table)
-        cols = _detect_finance_columns(table_fq)
-        sql = REPORTS[report_id]["sql"].format(
-            table_fq=table_fq,
-            department=cols["department"],
-            amount=cols["amount"],
-            date=cols["date"],
-            expense_type=cols["expense_type"] or "NULL",
-        )
-        columns, rows = _run_sql(sql, max_rows=limit)
+        key = (report_id, table, limit)
+        hit = _report_cache.get(key)
+        if hit and hit[0] > time.monotonic():
+            _, columns, rows = hit
+        else:
+            sql = _report_sql(report_id, _fq_table(table))
+            columns, rows = _run_sql(sql, max_rows=limit)
+            _cache_report(key, columns, rows)
         return jsonify({
             "success": True,
             "columns": columns,
@@ -470,32 +996,10 @@ def download_report():
         return "Missing or invalid parameters.", 400
 
     try:
-        table_fq = _fq_table(table)
-        cols = _detect_finance_columns(table_fq)
-        sql = REPORTS[report_id]["sql"].format(
-            table_fq=table_fq,
-            department=cols["department"],
-            amount=cols["amount"],
-            date=cols["date"],
-            expense_type=cols["expense_type"] or "NULL",
-        )
-        job = bq_client.query(sql)
-        result = job.result()
+        sql = _report_sql(report_id, _fq_table(table))
+        result = bq_client.query_and_wait(sql, page_size=ROWS_PER_CHUNK)
 
-        out = io.StringIO()
-        writer = csv.writer(out)
-        columns = [f.name for f in result.schema]
-        writer.writerow(columns)
-        for row in result:
-            writer.writerow(list(row.values()))
-        out.seek(0)
-
-        return send_file(
-            io.BytesIO(out.read().encode("utf-8")),
-            mimetype="text/csv",
-            as_attachment=True,
-            download_name=f"{report_id}_{table}.csv"
-        )
+        return _csv_response(result, f"{report_id}_{table}.csv")
     except Exception as e:
         return f"Error: {e}", 500
 
@@ -542,7 +1046,13 @@ def looker_help():
 # 🔹 Start Flask App
 # ===============================
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
+    # Local development only; the container serves the app with gunicorn
+    app.run(
+        host='0.0.0.0',
+        port=int(os.environ.get('PORT', 8080)),
+        threaded=True,
+        debug=os.environ.get('FLASK_ENV') == 'development',
+    )
 
 
 